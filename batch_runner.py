@@ -0,0 +1,251 @@
+"""
+this script runs charge state distribution simulations without user interface
+for a list of jobs from JSONL or CSV file, one job per line/row with fields:
+element, e_e, j_e, p_vac and optional t_ion (default 300 eV), ip (default 13.6 eV),
+log_t_min, log_t_max, n_t (log time grid, default -6, 1, 1000) or time (JSONL list),
+injection (initial charge state, default 0) or initial_csd (JSONL list),
+cx_max (default 1) and accuracy (default 1E-4), other fields are kept unchanged
+
+jobs are processed in chunks on all cores, every chunk is written to its own
+compressed numpy file in the output folder as soon as it is done, existing chunk
+files are skipped so an interrupted run continues where it stopped, a failing
+job (including a row that can not be parsed) stores its error message instead
+of CSD and does not stop the run
+
+usage: python batch_runner.py jobs.jsonl --output results --chunk-size 100
+
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time as timer
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+import numpy as np
+import csd
+
+DEFAULTS = {'t_ion': 300, 'ip': csd.CONST['Ry'], 'log_t_min': -6, 'log_t_max': 1, 'n_t': 1000,
+            'injection': 0, 'cx_max': 1, 'accuracy': 1E-4}
+INTEGER_FIELDS = ('n_t', 'injection', 'cx_max')
+FLOAT_FIELDS = ('e_e', 'j_e', 'p_vac', 't_ion', 'ip', 'log_t_min', 'log_t_max', 'accuracy')
+
+_ELEMENTS = {}  # element data loaded once per worker process
+
+
+def read_jobs(path):
+    """
+    generator of raw jobs from JSONL or CSV file, reads file line by line,
+    JSONL lines are yielded as text and CSV rows as dictionaries of strings,
+    they are parsed by parse_job in worker processes"""
+    with open(path, newline='') as jobs_file:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(jobs_file)
+        else:
+            yield from (line.strip() for line in jobs_file if line.strip())
+
+
+def parse_job(row):
+    """ job dictionary with defaults and numeric fields converted from raw job of read_jobs"""
+    if isinstance(row, str):
+        row = json.loads(row)
+    if not isinstance(row, dict):
+        raise ValueError('job should be a JSON object, got ' + str(row))
+    job = dict(DEFAULTS)
+    job.update({k: v for k, v in row.items() if v not in ('', None)})
+    for key in INTEGER_FIELDS:
+        job[key] = int(float(job[key]))
+    for key in FLOAT_FIELDS:
+        if key in job:
+            job[key] = float(job[key])
+    return job
+
+
+def count_jobs(path):
+    """ number of jobs in file without keeping them in memory"""
+    with open(path) as jobs_file:
+        lines = sum(1 for line in jobs_file if line.strip())
+    return lines - 1 if path.endswith('.csv') else lines
+
+
+def run_job(job):
+    """ CSD evolution for one job, returns time grid and solution"""
+    if job['element'] not in _ELEMENTS:
+        _ELEMENTS[job['element']] = csd.get_element_data(job['element'])
+    elem = _ELEMENTS[job['element']]
+    ch_states = np.linspace(0, len(elem), len(elem) + 1)  # define charge states
+    rates = csd.get_reaction_rates(elem=elem, j_e=job['j_e'], e_e=job['e_e'], t_ion=job['t_ion'],
+                                   p_vac=job['p_vac'], ip=job['ip'], ch_states=ch_states,
+                                   cx_max=job['cx_max'])
+    if 'time' in job:
+        time = np.array(job['time'], dtype=float)
+    else:
+        time = np.logspace(job['log_t_min'], job['log_t_max'], num=job['n_t'])
+    if 'initial_csd' in job:
+        initial_csd = np.array(job['initial_csd'], dtype=float)
+    else:
+        initial_csd = np.zeros(len(ch_states))
+        initial_csd[job['injection']] = 1
+    solution, _ = csd.solve_csd(initial_csd, time, csd.rate_bands(*rates), accuracy=job['accuracy'])
+    return time, solution
+
+
+def chunk_path(output, chunk_index):
+    return os.path.join(output, 'chunk_' + str(chunk_index).zfill(6) + '.npz')
+
+
+def run_chunk(output, chunk_index, first_job, jobs, final_only=False):
+    """
+    run jobs of one chunk and write them to one compressed file, written under
+    temporary name and renamed when complete so existing chunk file marks finished chunk,
+    failed job is stored as error_<index> message, returns number of jobs and failed jobs,
+    stored jobs are parsed or raw if parsing has failed"""
+    stored_jobs = list(jobs)
+    results = {}
+    failed = 0
+    for n, row in enumerate(jobs):
+        key = str(first_job + n)
+        try:
+            job = stored_jobs[n] = parse_job(row)
+            time, solution = run_job(job)
+        except Exception as error:
+            results['error_' + key] = np.array(type(error).__name__ + ': ' + str(error))
+            failed += 1
+            continue
+        if final_only:
+            results['csd_' + key] = solution[-1]
+        else:
+            results['time_' + key] = time
+            results['csd_' + key] = solution
+    results['jobs'] = np.array([json.dumps(job) for job in stored_jobs])
+    temporary = chunk_path(output, chunk_index) + '.tmp.npz'
+    np.savez_compressed(temporary, **results)
+    os.replace(temporary, chunk_path(output, chunk_index))
+    return len(jobs), failed
+
+
+def count_failed(path):
+    """ number of failed jobs stored in chunk file"""
+    with np.load(path) as chunk:
+        return sum(1 for key in chunk.files if key.startswith('error_'))
+
+
+def pending_chunks(jobs_path, output, chunk_size):
+    """ generator of (chunk index, first job index, jobs) for chunks without result file"""
+    jobs = read_jobs(jobs_path)
+    chunk_index = 0
+    while True:
+        chunk = list(islice(jobs, chunk_size))
+        if not chunk:
+            return
+        if not os.path.exists(chunk_path(output, chunk_index)):
+            yield chunk_index, chunk_index * chunk_size, chunk
+        chunk_index += 1
+
+
+def file_hash(path):
+    """ SHA-256 of file contents read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as jobs_file:
+        for block in iter(lambda: jobs_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def check_run_settings(output, jobs_path, chunk_size, final_only=False):
+    """
+    store job file hash, chunk size and stored results of the run, resuming with
+    different jobs, chunking or final_only setting would mix up chunks"""
+    settings = {'jobs': os.path.abspath(jobs_path), 'jobs_sha256': file_hash(jobs_path),
+                'chunk_size': chunk_size, 'final_only': final_only}
+    settings_path = os.path.join(output, 'run.json')
+    if os.path.exists(settings_path):
+        with open(settings_path) as settings_file:
+            previous = json.load(settings_file)
+        if previous.get('jobs_sha256') != settings['jobs_sha256']:
+            raise ValueError('output folder was started with different job file ' + str(previous['jobs']) +
+                             ', resume with the same jobs or use new output folder')
+        if previous['chunk_size'] != chunk_size:
+            raise ValueError('output folder was started with chunk size ' + str(previous['chunk_size']) +
+                             ', resume with the same chunk size or use new output folder')
+        if previous.get('final_only') != final_only:
+            raise ValueError('output folder was started with final_only=' + str(previous.get('final_only')) +
+                             ', resume with the same setting or use new output folder')
+    else:
+        with open(settings_path, 'w') as settings_file:
+            json.dump(settings, settings_file)
+
+
+def run(jobs_path, output='batch_output', chunk_size=100, workers=None, final_only=False):
+    """
+    run all unfinished chunks of jobs file on worker processes keeping at most
+    two chunks per worker in flight, prints progress, failed jobs, throughput and ETA,
+    returns number of finished jobs including failed ones"""
+    os.makedirs(output, exist_ok=True)
+    check_run_settings(output, jobs_path, chunk_size, final_only)
+    workers = workers or os.cpu_count()
+    total = count_jobs(jobs_path)
+    finished_chunks = [index for index in range(-(-total // chunk_size))
+                       if os.path.exists(chunk_path(output, index))]
+    done = sum(min(chunk_size, total - index * chunk_size) for index in finished_chunks)
+    failed = sum(count_failed(chunk_path(output, index)) for index in finished_chunks)
+    if done:
+        print('resuming,', done, 'of', total, 'jobs already done,', failed, 'failed')
+    start_time = timer.time()
+    finished_now = 0
+    chunks = pending_chunks(jobs_path, output, chunk_size)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        while True:
+            for chunk_index, first_job, jobs in islice(chunks, 2 * workers - len(in_flight)):
+                in_flight.add(executor.submit(run_chunk, output, chunk_index, first_job, jobs, final_only))
+            if not in_flight:
+                break
+            completed, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in completed:
+                finished_chunk, failed_chunk = future.result()
+                finished_now += finished_chunk
+                failed += failed_chunk
+            elapsed = timer.time() - start_time
+            throughput = finished_now / elapsed
+            remaining = total - done - finished_now
+            print(done + finished_now, '/', total, 'jobs,', failed, 'failed,',
+                  round(throughput, 1), 'jobs/s, ETA', round(remaining / throughput), 's', flush=True)
+    return done + finished_now
+
+
+def load_results(output):
+    """
+    generator of (job index, job, time, csd, error) from chunk files of a finished run,
+    time is None for final_only runs, csd is None and error is message for failed jobs,
+    job is raw row of the job file if it could not be parsed"""
+    for name in sorted(os.listdir(output)):
+        if name.startswith('chunk_') and name.endswith('.npz') and not name.endswith('.tmp.npz'):
+            with np.load(os.path.join(output, name)) as chunk:
+                indices = sorted(int(key.split('_')[1]) for key in chunk.files
+                                 if key.startswith('csd_') or key.startswith('error_'))
+                for index, job in zip(indices, chunk['jobs']):
+                    key = str(index)
+                    if 'error_' + key in chunk.files:
+                        yield index, json.loads(str(job)), None, None, str(chunk['error_' + key])
+                        continue
+                    time = chunk['time_' + key] if 'time_' + key in chunk.files else None
+                    yield index, json.loads(str(job)), time, chunk['csd_' + key], None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='headless CSD simulations for a list of jobs')
+    parser.add_argument('jobs', help='JSONL or CSV file with one job per line')
+    parser.add_argument('--output', default='batch_output', help='folder for chunk result files')
+    parser.add_argument('--chunk-size', type=int, default=100, help='jobs per result file')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, default all cores')
+    parser.add_argument('--final-only', action='store_true', help='store only CSD at the last time point')
+    args = parser.parse_args()
+    run(args.jobs, output=args.output, chunk_size=args.chunk_size,
+        workers=args.workers, final_only=args.final_only)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,8 @@ import json
 import numpy as np  # import numpy for general array operations
 from bokeh.models import PrintfTickFormatter, HoverTool, Legend
 from bokeh.plotting import figure
+from scipy.integrate import odeint  # import odeint to integrate system of ODE
+from scipy.linalg import expm
 import numba
 from numba import jit
 
@@ -36,6 +38,20 @@ ELEM_MASSES = [1.0079, 4.0026, 6.941, 9.0122, 10.811, 12.0107, 14.0067, 15.9994,
 
 CONST = {"k_b": 1.38E-23, "q": 1.6E-19, "RT": 300, "Ry": 13.6}
 
+# constants of Kim and Pratt RR cross section
+RR_CONST = {"alpha": 1 / 137.035,  # fine-structure const
+            "lambda_e": 3.86E-11,  # electron reduced(!) Compton wavelength
+            "Ry": 13.605,  # Hydrogen atom ionization potential
+            "c_rr": 8.0 * 3.1416 / (3.0 * (3.0) ** 0.5)}  # norming constant
+
+# electron states in shells by principal quantum number
+PRINCIPAL_N_STATES = {1: 2, 2: 8, 3: 18, 4: 32, 5: 50, 6: 72, 7: 98}
+
+# Mueller and Salzborn coefficients for capture of 1..4 electrons
+CX_SCALING_FACTOR = np.array([1.43e-12, 1.08e-12, 5.5e-14, 3.57e-16])
+CX_ALPHA = np.array([1.17, 0.71, 2.1, 4.2])
+CX_BETA = np.array([-2.76, -2.8, -2.89, -3.03])
+
 @jit()
 def color_picker(total_items, current_item, palette):
     """ pick color for charge states"""
@@ -44,21 +60,24 @@ def color_picker(total_items, current_item, palette):
     if total_items >= len(palette):
         return palette[current_item % len(palette)]
 
+
+@jit(nopython=True)
+def mueller_salzborn_cs(i, k, ionization_potential):
+    """
+    see original Salborn Mueller publication
+    https://doi.org/10.1016/0375-9601(77)90672-7
+    works for charge state i given as number or array"""
+    return CX_SCALING_FACTOR[k - 1] * i ** CX_ALPHA[k - 1] * ionization_potential ** CX_BETA[k - 1]
+
+
 #just-in-time compiled function with predefined signature to speed up calculation
-@jit(numba.float64(numba.int32,numba.int32,numba.float32), nopython=True)
+@jit(numba.float64(numba.int32,numba.int32,numba.float64), nopython=True)
 def cx_sm_cs(i, k, ionization_potential):
     """Charge exchange cross section for single and multiple electron capture"""
     if i == 0:
         sigma = 0
     else:
-        """
-        see original Salborn Mueller publication
-        https://doi.org/10.1016/0375-9601(77)90672-7
-        """
-        scaling_factor = np.array([1.43e-12, 1.08e-12, 5.5e-14, 3.57e-16])
-        alpha = np.array([1.17, 0.71, 2.1, 4.2])
-        beta = np.array([-2.76, -2.8, -2.89, -3.03])
-        sigma = scaling_factor[k - 1] * i ** alpha[k - 1] * (ionization_potential) ** beta[k - 1]
+        sigma = mueller_salzborn_cs(i, k, ionization_potential)
     return sigma
 
 
@@ -70,8 +89,6 @@ def shell_stat(elem, i):
     if i == len(elem):  # stats for bare ion
         return [1, 2, 0]
     else:
-        # electron states in shells by principal quantum number
-        principal_n_states = {1: 2, 2: 8, 3: 18, 4: 32, 5: 50, 6: 72, 7: 98}
         # population of subshells by principal quantum numbers with repeats
         populations = {subshell: elem[i][subshell]['p'] for subshell in elem[i].keys()}
         # get only unique values of principal quantum number
@@ -86,7 +103,7 @@ def shell_stat(elem, i):
         principal_q_number = len(principal_n_population)
 
         # get total number of states in that shell
-        states = principal_n_states[principal_q_number]
+        states = PRINCIPAL_N_STATES[principal_q_number]
 
         return [principal_q_number, states, principal_n_population[principal_q_number]]
 
@@ -96,24 +113,26 @@ def rr_pk_cs(elem, i, e_e):
     see original publication by Kim and Pratt
     https://doi.org/10.1103/PhysRevA.27.2913"""
     nuclear_charge = len(elem)
-    alpha = 1 / 137.035  # fine-structure const
-    lambda_e = 3.86E-11  # electron reduced(!) Compton wavelength
-    rydberg = 13.605  # Hydrogen atom ionization potential
-    c_rr = 8.0 * 3.1416 / (3.0 * (3.0) ** 0.5)  # norming constant
     if i == 0:
         sigma = 0
     else:
-        q_eff = 0.5 * (nuclear_charge + i)  # effective charge of the ion
-        chi = 2 * q_eff ** 2 * rydberg / e_e  # chi factor
         n_outermost = shell_stat(elem, i)[0]  # principal quantum number of the outermost shell
         # statistical  weight
         wn0 = (shell_stat(elem, i)[1] - shell_stat(elem, i)[2]) / shell_stat(elem, i)[1]
-        n0_eff = n_outermost + (1 - wn0) - 0.3  # effective quantum number
-        # cross section
-        sigma = c_rr * alpha * lambda_e ** 2 * chi * np.log(1 + chi / (2 * n0_eff ** 2))
+        sigma = kim_pratt_cs(nuclear_charge, i, e_e, n_outermost, wn0)
     return sigma
 
 
+def kim_pratt_cs(nuclear_charge, i, e_e, n_outermost, wn0):
+    """
+    Kim and Pratt RR cross section from outermost shell number and its statistical weight,
+    works for numbers and arrays"""
+    q_eff = 0.5 * (nuclear_charge + i)  # effective charge of the ion
+    chi = 2 * q_eff ** 2 * RR_CONST['Ry'] / e_e  # chi factor
+    n0_eff = n_outermost + (1 - wn0) - 0.3  # effective quantum number
+    return RR_CONST['c_rr'] * RR_CONST['alpha'] * RR_CONST['lambda_e'] ** 2 * chi * np.log(1 + chi / (2 * n0_eff ** 2))
+
+
 def ei_lotz_cs(elem, i, e_e):
     """
     see original publication by Lotz
@@ -136,10 +155,16 @@ def ei_lotz_cs(elem, i, e_e):
                            if condition[subshell]])
         lotz_c = np.array([elem[i][subshell]['c'] for subshell in elem[i].keys()
                            if condition[subshell]])
-        sigma = sum(lotz_a * (1 - lotz_b * np.exp(-1 * lotz_c * ((e_e / energies) - 1)))
-                    * populations * np.log(e_e / energies) / (e_e * energies))
+        sigma = sum(lotz_terms(e_e, energies, populations, lotz_a, lotz_b, lotz_c))
     return sigma * 1E-14
 
+
+def lotz_terms(e_e, energies, populations, lotz_a, lotz_b, lotz_c):
+    """ Lotz formula terms of subshells, sum times 1E-14 is EI cross section in cm2"""
+    return (lotz_a * (1 - lotz_b * np.exp(-1 * lotz_c * ((e_e / energies) - 1)))
+            * populations * np.log(e_e / energies) / (e_e * energies))
+
+
 #Just-in-time compiled function to speed up calculation
 @jit( nopython=True)
 def csd_evolution(abundances, time, rei, rrr, rcx):
@@ -159,6 +184,158 @@ def csd_evolution(abundances, time, rei, rrr, rcx):
 
     return derivatives
 
+def rate_bands(rei, rrr, rcx):
+    """
+    assemble rate matrix of the CSD system once in banded storage
+    bands[upper + i - j, j] = matrix[i][j], one lower diagonal for EI and
+    upper diagonals for RR and single to multiple electron CX.
+    rcx is either a vector of single capture rates or an array of shape
+    (k_max, charge states) with rates of capturing 1..k_max electrons,
+    capture of more electrons than the highest charge has no band.
+    Leading dimensions of all rates are treated as a batch of elements"""
+    rei = np.asarray(rei)
+    rcx = np.asarray(rcx)
+    if rcx.ndim == rei.ndim:  # single electron capture
+        rcx = rcx[..., np.newaxis, :]
+    # odeint needs fewer upper diagonals than charge states
+    upper = min(rcx.shape[-2], rei.shape[-1] - 1)
+    bands = np.zeros(rei.shape[:-1] + (upper + 2, rei.shape[-1]))
+    # EI feeds charge state i+1 from i, not possible from bare ion
+    bands[..., upper + 1, :-1] = rei[..., :-1]
+    bands[..., upper, :-1] -= rei[..., :-1]
+    # RR feeds charge state i-1 from i, not possible for neutral
+    bands[..., upper - 1, 1:] += rrr[..., 1:]
+    bands[..., upper, 1:] -= rrr[..., 1:]
+    # capture of k electrons feeds charge state i-k from i
+    for k in range(1, upper + 1):
+        bands[..., upper - k, k:] += rcx[..., k - 1, k:]
+        bands[..., upper, k:] -= rcx[..., k - 1, k:]
+    return bands
+
+#Just-in-time compiled function to speed up calculation
+@jit(nopython=True)
+def csd_evolution_banded(abundances, time, bands):
+    """
+    RHS for time derivative system of equations with banded rate matrix from rate_bands"""
+    n_states = len(abundances)
+    upper = bands.shape[0] - 2
+    derivatives = np.zeros(n_states)
+    for row in range(bands.shape[0]):
+        offset = row - upper  # i - j for this diagonal
+        for j in range(max(0, -offset), min(n_states, n_states - offset)):
+            derivatives[j + offset] += bands[row, j] * abundances[j]
+    return derivatives
+
+
+def csd_jacobian_banded(abundances, time, bands):
+    """ Jacobian of the linear CSD system in odeint banded format is the rate matrix itself"""
+    return bands
+
+
+def solve_csd_banded(initial_csd, time, bands, **kwargs):
+    """
+    integrate CSD evolution with banded rate matrix and banded Jacobian,
+    extra keyword arguments are passed to odeint"""
+    return odeint(csd_evolution_banded, initial_csd, time, args=(bands,),
+                  Dfun=csd_jacobian_banded, ml=1, mu=bands.shape[0] - 2, **kwargs)
+
+def choose_solver(bands, accuracy=1E-4, n_states=None):
+    """
+    pick tolerances of CSD integration to reach absolute accuracy of abundances,
+    n_states is number of charge states sharing unit abundance, by default all.
+    Integration uses LSODA which switches between non-stiff Adams and stiff BDF
+    methods by itself, cheaper than any fixed choice for these systems.
+    Stiffness ratio and number of decades spanned by loss rates are reported
+    to characterize conditioning of the system"""
+    loss_rates = np.abs(bands[bands.shape[0] - 2])
+    fastest = loss_rates.max()
+    slowest = loss_rates[loss_rates > 0].min() if fastest > 0 else 0
+    # local tolerances one order below the target, for a dissipative linear
+    # system global error stays close to the local one
+    settings = {'method': 'LSODA',
+                'rtol': accuracy / 10,
+                'atol': accuracy / (10 * (n_states or bands.shape[1])),
+                'stiffness_ratio': fastest / slowest if slowest > 0 else np.inf,
+                'rate_decades': np.log10(fastest / slowest) if slowest > 0 else 0.0}
+    return settings
+
+
+def integrate_csd(initial_csd, time, bands, settings):
+    """
+    integrate CSD evolution with LSODA, banded Jacobian and tolerances from choose_solver,
+    adds to settings fraction of output intervals where LSODA used stiff BDF method"""
+    solution, info = solve_csd_banded(initial_csd, time, bands, rtol=settings['rtol'],
+                                      atol=settings['atol'], full_output=True)
+    if info['message'] not in ('Integration successful.', 'Nothing was done; the integration time was 0.'):
+        raise RuntimeError('CSD integration failed: ' + info['message'])
+    # method used at each output time, 1 - Adams, 2 - BDF
+    settings['stiff_fraction'] = float(np.mean(info['mused'] == 2)) if len(info['mused']) else 0.0
+    return solution
+
+
+def solve_csd(initial_csd, time, bands, accuracy=1E-4):
+    """
+    integrate CSD evolution with tolerances chosen by choose_solver,
+    clips negative abundances and restores total abundance of initial CSD.
+    returns solution and dictionary reporting solver choice and corrections made"""
+    settings = choose_solver(bands, accuracy)
+    solution = integrate_csd(initial_csd, time, bands, settings)
+    total = np.sum(initial_csd)
+    settings['max_negative'] = max(0.0, -solution.min())
+    settings['max_drift'] = np.abs(solution.sum(axis=1) - total).max()
+    solution = np.clip(solution, 0, None)
+    sums = solution.sum(axis=1)
+    solution = solution * (total / np.where(sums > 0, sums, 1))[:, np.newaxis]
+    return solution, settings
+
+def bands_to_matrix(bands):
+    """ unpack banded rate matrix from rate_bands to a dense square matrix"""
+    n_states = bands.shape[1]
+    upper = bands.shape[0] - 2
+    matrix = np.zeros((n_states, n_states))
+    for row in range(bands.shape[0]):
+        offset = row - upper  # i - j for this diagonal
+        columns = np.arange(max(0, -offset), min(n_states, n_states - offset))
+        matrix[columns + offset, columns] = bands[row, columns]
+    return matrix
+
+
+def cycle_propagator(bands, breeding_time):
+    """ matrix propagating CSD over one breeding period of constant rates"""
+    return expm(bands_to_matrix(bands) * breeding_time)
+
+
+def periodic_csd(bands, breeding_time, injection, extraction=1, cycles=None):
+    """
+    CSD of repeated breed and extract cycles: each cycle injects injection CSD
+    into the trap, breeds for breeding_time and extracts given fraction
+    (scalar or per charge state) of every charge state, the rest is kept
+    for the next cycle. With cycles=None periodic steady state is solved
+    directly, otherwise the state after given number of cycles starting from
+    empty trap is found with propagator powers, cost grows as log(cycles).
+    returns CSD in the trap at the end of breeding and extracted yields per pulse"""
+    n_states = bands.shape[1]
+    extraction = np.broadcast_to(np.asarray(extraction, dtype=float), (n_states,))
+    propagator = cycle_propagator(bands, breeding_time)
+    # one cycle is an affine map of the trap CSD at the end of breeding
+    cycle_matrix = propagator * (1 - extraction)[np.newaxis, :]
+    cycle_offset = propagator.dot(injection)
+    if cycles is None:
+        # rates conserve ions, if extraction misses charge states where ions
+        # accumulate the fixed point equation is singular or nearly so
+        fixed_point_matrix = np.eye(n_states) - cycle_matrix
+        if np.linalg.cond(fixed_point_matrix) > 1E10:
+            raise ValueError('no periodic steady state: ions accumulate in charge states '
+                             'which are not extracted, extract the charge states reached during breeding')
+        trap_csd = np.linalg.solve(fixed_point_matrix, cycle_offset)
+    else:
+        affine = np.zeros((n_states + 1, n_states + 1))
+        affine[:n_states, :n_states] = cycle_matrix
+        affine[:n_states, n_states] = cycle_offset
+        affine[n_states, n_states] = 1
+        trap_csd = np.linalg.matrix_power(affine, cycles)[:n_states, n_states]
+    return trap_csd, extraction * trap_csd
+
 # use add_custom_hover=False call for plotting with bokeh multiline
 def csd_base_figure(add_legend=True, add_custom_hover=True):
     """ function to make a CSD plot dummy"""
@@ -240,6 +417,49 @@ def get_element_data(name):
     return elem
 
 
+def get_elements_data(names):
+    """ import data of several elements reading JSON once,
+    returns list of element dictionaries with charge states as iteger keys"""
+    with open('elements.json') as element_json:
+        elements_data = json.load(element_json)
+    return [{int(k): v for k, v in elements_data[name].items()} for name in names]
+
+
+def pack_elements(elems):
+    """
+    pack list of element dictionaries into zero padded arrays of shape
+    (elements, charge states, subshells) for vectorized calculations,
+    charge states run from neutral to bare ion, 'present' marks subshells
+    listed for a charge state, 'valid' marks charge states of each element and
+    'subshells' names the subshell columns in order of their appearance in element data"""
+    n_max = max(len(elem) for elem in elems) + 1
+    subshells = list(dict.fromkeys(subshell for elem in elems
+                                   for charge_state in elem.values() for subshell in charge_state))
+    shape = (len(elems), n_max, len(subshells))
+    packed = {key: np.zeros(shape) for key in ('E', 'p', 'a', 'b', 'c')}
+    packed['present'] = np.zeros(shape, dtype=bool)
+    packed['subshells'] = subshells
+    columns = {subshell: s for s, subshell in enumerate(subshells)}
+    # collect values as flat lists and scatter them at once
+    index = ([], [], [])
+    values = {key: [] for key in ('E', 'p', 'a', 'b', 'c')}
+    for e, elem in enumerate(elems):
+        for i, charge_state in elem.items():
+            for subshell, data in charge_state.items():
+                index[0].append(e)
+                index[1].append(i)
+                index[2].append(columns[subshell])
+                for key in values:
+                    values[key].append(data[key])
+    packed['present'][index] = True
+    for key in values:
+        packed[key][index] = values[key]
+    packed['nuclear_charge'] = np.array([len(elem) for elem in elems])
+    packed['valid'] = np.arange(n_max) <= packed['nuclear_charge'][:, np.newaxis]
+    packed['mass'] = np.array([ELEM_MASSES[len(elem) - 1] for elem in elems])
+    return packed
+
+
 def get_neutral_density(pressure, t_gas=CONST['RT']):
     """
     returns neutral signal"""
@@ -251,21 +471,147 @@ def get_neutral_density(pressure, t_gas=CONST['RT']):
 def get_ion_velocity(elem, t_ion):
     """
     returns ion velocity in cm/s"""
-    m_i = ELEM_MASSES[len(elem) - 1] * 1.6726E-27  # ion mass kg
-    v_i = 100 * (8 * t_ion * 1.6E-19 / (3.1416 * m_i)) ** 0.5  # ion velocity cm/s
+    return ion_velocity(ELEM_MASSES[len(elem) - 1], t_ion)
+
+
+def ion_velocity(mass, t_ion):
+    """
+    returns mean thermal velocity in cm/s of ions with mass in atomic units
+    and temperature in eV, works for numbers and arrays"""
+    m_i = mass * 1.6726E-27  # ion mass kg
+    v_i = 100 * (8 * t_ion * CONST['q'] / (3.1416 * m_i)) ** 0.5  # ion velocity cm/s
     return v_i
 
 
-def get_reaction_rates(*, elem, j_e, e_e, t_ion, p_vac, ip, ch_states):
+def get_cross_sections(*, elem, e_e, ip, ch_states, cx_max=1):
     """
-    returs tuple of EI,RR and CX reaction rates for given conditions
+    returs tuple of EI,RR and CX cross sections in cm2 for given conditions
+    with cx_max > 1 CX cross sections are returned as array of shape (cx_max, charge states)
+    for capture of 1..cx_max electrons in one collision
     """
+    if not 1 <= cx_max <= 4:
+        raise ValueError('cx_max should be between 1 and 4, got ' + str(cx_max))
+    rr_cs = np.array([rr_pk_cs(elem, i, e_e) for i in ch_states])
+    ei_cs = np.array([ei_lotz_cs(elem, i, e_e) for i in ch_states])
+    # ion can not capture more electrons than its charge
+    cx_cs = np.array([[cx_sm_cs(i, k, ip) if i >= k else 0 for i in ch_states]
+                      for k in range(1, cx_max + 1)])
+    if cx_max == 1:
+        cx_cs = cx_cs[0]
+    return (ei_cs, rr_cs, cx_cs)
+
+
+def get_rates_from_cross_sections(*, elem, j_e, t_ion, p_vac, cross_sections):
+    """
+    converts tuple of EI,RR and CX cross sections from get_cross_sections
+    to tuple of reaction rates for given beam and vacuum conditions
+    """
+    ei_cs, rr_cs, cx_cs = cross_sections
     q = CONST['q']  # elementary charge
     v_i = get_ion_velocity(elem, t_ion)  # ion velocity cm/s
     n_0 = get_neutral_density(p_vac)  # neutrals density per cubic cm
 
-    rrr = j_e / q * (np.array([rr_pk_cs(elem, i, e_e) for i in ch_states]))
-    rei = j_e / q * (np.array([ei_lotz_cs(elem, i, e_e) for i in ch_states]))
-    rcx = n_0 * v_i * (np.array([cx_sm_cs(i, 1, ip) for i in ch_states]))
+    rrr = j_e / q * rr_cs
+    rei = j_e / q * ei_cs
+    rcx = n_0 * v_i * cx_cs
 
     return (rei, rrr, rcx)
+
+
+def get_batch_cross_sections(*, packed, e_e, ip, cx_max=1):
+    """
+    vectorized get_cross_sections for all charge states of elements packed by
+    pack_elements, returns EI, RR and CX cross sections of shape (elements, charge states),
+    CX of shape (elements, cx_max, charge states) if cx_max > 1, zero for padding
+    """
+    if not 1 <= cx_max <= 4:
+        raise ValueError('cx_max should be between 1 and 4, got ' + str(cx_max))
+    present = packed['present']
+    ch_states = np.arange(present.shape[1])[np.newaxis, :]
+    nuclear_charge = packed['nuclear_charge'][:, np.newaxis]
+    ions = packed['valid'] & (ch_states > 0)
+
+    # Lotz formula over subshells open for ionization, see ei_lotz_cs
+    energies, populations = packed['E'], packed['p']
+    open_subshells = present & (energies < e_e) & (populations > 0) & (energies > 0)
+    energies = np.where(open_subshells, energies, e_e)
+    ei_cs = np.where(open_subshells, lotz_terms(e_e, energies, populations, packed['a'], packed['b'], packed['c']),
+                     0).sum(axis=-1) * 1E-14
+
+    # Kim and Pratt formula with shell statistics, see rr_pk_cs and shell_stat
+    principal_n = np.array([int(subshell[0]) for subshell in packed['subshells']])
+    shells = np.arange(1, principal_n.max() + 1)
+    in_shell = present[..., np.newaxis] & (principal_n[:, np.newaxis] == shells)
+    n_outermost = in_shell.any(axis=-2).sum(axis=-1)
+    shell_population = np.where(principal_n == n_outermost[..., np.newaxis], packed['p'] * present, 0).sum(axis=-1)
+    bare = ch_states == nuclear_charge
+    n_outermost = np.where(bare | ~packed['valid'], 1, n_outermost)
+    shell_population = np.where(bare, 0, shell_population)
+    shell_states = np.zeros(max(PRINCIPAL_N_STATES) + 1)
+    shell_states[list(PRINCIPAL_N_STATES)] = list(PRINCIPAL_N_STATES.values())
+    states = shell_states[n_outermost]
+    wn0 = (states - shell_population) / states  # statistical  weight
+    rr_cs = np.where(ions, kim_pratt_cs(nuclear_charge, ch_states, e_e, n_outermost, wn0), 0)
+
+    # Mueller and Salzborn formula, see cx_sm_cs
+    cx_cs = np.array([np.where(ions & (ch_states >= k),
+                               mueller_salzborn_cs(ch_states.astype(float), k, float(ip)), 0)
+                      for k in range(1, cx_max + 1)]).transpose(1, 0, 2)
+    if cx_max == 1:
+        cx_cs = cx_cs[:, 0]
+    return (ei_cs, rr_cs, cx_cs)
+
+
+def get_batch_reaction_rates(*, packed, j_e, e_e, t_ion, p_vac, ip, cx_max=1):
+    """
+    vectorized get_reaction_rates for elements packed by pack_elements,
+    returns EI, RR and CX rates with the shapes of get_batch_cross_sections
+    """
+    ei_cs, rr_cs, cx_cs = get_batch_cross_sections(packed=packed, e_e=e_e, ip=ip, cx_max=cx_max)
+    q = CONST['q']  # elementary charge
+    v_i = ion_velocity(packed['mass'], t_ion)  # ion velocity cm/s
+    n_0 = get_neutral_density(p_vac)  # neutrals density per cubic cm
+    v_i = v_i.reshape((-1,) + (1,) * (cx_cs.ndim - 1))
+    return (j_e / q * ei_cs, j_e / q * rr_cs, n_0 * v_i * cx_cs)
+
+
+def scan_elements(names, *, j_e, e_e, t_ion, p_vac, ip, time, injection=0, cx_max=1, accuracy=1E-4):
+    """
+    CSD evolution of several elements at one operating point solved together,
+    rates of all elements are packed in one padded (element x charge state)
+    tensor, only real charge states are integrated as one block banded system.
+    returns masked array of shape (elements, time, charge states), padding is masked
+    """
+    packed = pack_elements(get_elements_data(names))
+    if not 0 <= injection <= packed['nuclear_charge'].min():
+        raise ValueError('injection charge state should be between 0 and ' +
+                         str(packed['nuclear_charge'].min()) + ' for all elements, got ' + str(injection))
+    valid = packed['valid']
+    rates = get_batch_reaction_rates(packed=packed, j_e=j_e, e_e=e_e, t_ion=t_ion,
+                                     p_vac=p_vac, ip=ip, cx_max=cx_max)
+    bands = rate_bands(*rates)
+    # drop padding, blocks of elements do not couple as rates at their edges are zero
+    block_bands = bands.transpose(1, 0, 2)[:, valid]
+    initial_csd = np.zeros(valid.shape)
+    initial_csd[:, injection] = 1
+    settings = choose_solver(block_bands, accuracy, n_states=valid.shape[1])
+    block_solution = integrate_csd(initial_csd[valid], time, block_bands, settings)
+
+    solution = np.zeros((len(time),) + valid.shape)
+    solution[:, valid] = np.clip(block_solution, 0, None)
+    solution = solution.transpose(1, 0, 2)
+    # restore unit abundance of each element
+    sums = solution.sum(axis=-1, keepdims=True)
+    solution = solution / np.where(sums > 0, sums, 1)
+    return np.ma.masked_array(solution, mask=np.broadcast_to(~valid[:, np.newaxis, :], solution.shape))
+
+
+def get_reaction_rates(*, elem, j_e, e_e, t_ion, p_vac, ip, ch_states, cx_max=1):
+    """
+    returs tuple of EI,RR and CX reaction rates for given conditions
+    with cx_max > 1 CX rates are returned as array of shape (cx_max, charge states)
+    with rates of capturing 1..cx_max electrons in one collision
+    """
+    cross_sections = get_cross_sections(elem=elem, e_e=e_e, ip=ip, ch_states=ch_states, cx_max=cx_max)
+    return get_rates_from_cross_sections(elem=elem, j_e=j_e, t_ion=t_ion, p_vac=p_vac,
+                                         cross_sections=cross_sections)
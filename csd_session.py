@@ -0,0 +1,187 @@
+"""
+This script contains simulation session for interactive applications.
+Session keeps intermediate results of CSD simulation organized in a small
+dependency graph element -> cross sections -> rates -> solution -> view,
+each stage is recalculated only when its inputs have changed and display
+only changes patch existing bokeh figures in place.
+
+"""
+import numpy as np
+from bokeh.models import ColumnDataSource, LabelSet
+from bokeh.palettes import Category20_20 as palette  # palette for charge states
+from bokeh.palettes import Category10_4 as cs_palette  # palette for cross sections
+import csd
+
+DEFAULTS = {'element': 'K', 'e_e': 5000, 'j_e': 1000, 'p_vac': 1E-10, 't_ion': 100,
+            'ip': csd.CONST['Ry'], 'cx_max': 1, 'log_t': (-6, 0), 'injection': 0,
+            'accuracy': 1E-4, 'min_ch_state': 0, 'max_ch_state': None,
+            'show_legend': True, 'show_labels': True}
+
+# stage: (upstream stages, simulation parameters it depends on)
+STAGES = {'element': ((), ('element',)),
+          'cross_sections': (('element',), ('e_e', 'ip', 'cx_max')),
+          'rates': (('element', 'cross_sections'), ('j_e', 't_ion', 'p_vac')),
+          'solution': (('rates',), ('log_t', 'injection', 'accuracy'))}
+
+
+class SimulationSession:
+    """
+    CSD simulation with cached stages, update parameters with update(),
+    get stage results with get() and refresh figures with refresh_view()"""
+
+    def __init__(self, **params):
+        self.params = dict(DEFAULTS)
+        self.params.update(params)
+        self.recalculated = []  # stages recalculated since last update
+        self._values = {}
+        self._keys = {}
+        self._versions = {stage: 0 for stage in STAGES}
+        self._csd_plot = None
+        self._cs_plot = None
+        self._view_key = None
+        self._cs_view_key = None
+
+    def update(self, **params):
+        """ set simulation and display parameters"""
+        unknown = set(params) - set(DEFAULTS)
+        if unknown:
+            raise ValueError('unknown parameters ' + ', '.join(sorted(unknown)))
+        self.params.update(params)
+        self.recalculated = []
+
+    def get(self, stage):
+        """ result of a stage, recalculated only if its inputs have changed"""
+        upstream, param_names = STAGES[stage]
+        for name in upstream:
+            self.get(name)
+        key = (tuple(self.params[name] for name in param_names),
+               tuple(self._versions[name] for name in upstream))
+        if self._keys.get(stage) != key:
+            self._values[stage] = getattr(self, '_calculate_' + stage)()
+            self._keys[stage] = key
+            self._versions[stage] += 1
+            self.recalculated.append(stage)
+        return self._values[stage]
+
+    def _calculate_element(self):
+        elem = csd.get_element_data(self.params['element'])
+        ch_states = np.linspace(0, len(elem), len(elem) + 1)  # define charge states
+        return elem, ch_states
+
+    def _calculate_cross_sections(self):
+        elem, ch_states = self._values['element']
+        return csd.get_cross_sections(elem=elem, e_e=self.params['e_e'], ip=self.params['ip'],
+                                      ch_states=ch_states, cx_max=self.params['cx_max'])
+
+    def _calculate_rates(self):
+        elem, _ = self._values['element']
+        rates = csd.get_rates_from_cross_sections(elem=elem, j_e=self.params['j_e'],
+                                                  t_ion=self.params['t_ion'],
+                                                  p_vac=self.params['p_vac'],
+                                                  cross_sections=self._values['cross_sections'])
+        return csd.rate_bands(*rates)
+
+    def _calculate_solution(self):
+        bands = self._values['rates']
+        log_t = self.params['log_t']
+        time = np.logspace(log_t[0], log_t[1], num=1000)  # generate  log linear time range
+        initial_csd = np.zeros(bands.shape[1])
+        initial_csd[self.params['injection']] = 1
+        solution, _ = csd.solve_csd(initial_csd, time, bands, accuracy=self.params['accuracy'])
+        return time, solution
+
+    def shown_ch_states(self):
+        """ range of charge states selected for display"""
+        _, ch_states = self.get('element')
+        max_ch_state = self.params['max_ch_state']
+        if max_ch_state is None:
+            max_ch_state = len(ch_states) - 1
+        return range(max(0, int(self.params['min_ch_state'])),
+                     min(len(ch_states), int(max_ch_state) + 1))
+
+    def csd_figure(self):
+        """ CSD figure created once, contents are updated by refresh_view()"""
+        if self._csd_plot is None:
+            self._csd_plot = csd.csd_base_figure(add_custom_hover=False)
+            self._csd_source = ColumnDataSource({name: [] for name in (
+                'xs', 'ys', 'color', 'legend_label', 'x_label', 'y_label', 'text_label')})
+            self._csd_plot.multi_line('xs', 'ys', color='color', line_width=3,
+                                      muted_alpha=0.2, legend_field='legend_label',
+                                      source=self._csd_source)
+            self._labels = LabelSet(x='x_label', y='y_label', text='text_label',
+                                    source=self._csd_source, level="overlay",
+                                    render_mode="canvas", text_font_size="10pt",
+                                    text_color='color', background_fill_color="white",
+                                    border_line_color="white")
+            self._csd_plot.add_layout(self._labels)
+            self._csd_plot.title.text_font_style = "normal"
+            self._csd_plot.sizing_mode = 'stretch_width'
+        return self._csd_plot
+
+    def cs_figure(self):
+        """ cross sections figure created once, contents are updated by refresh_view()"""
+        if self._cs_plot is None:
+            self._cs_plot = csd.cs_base_figure()
+            self._cs_sources = [ColumnDataSource({'x': [], 'y': []}) for _ in range(3)]
+            for source, color, label in zip(self._cs_sources, cs_palette[:2] + cs_palette[3:],
+                                            ['Impact ionization', 'radiative recombination',
+                                             'charge exchange']):
+                self._cs_plot.line('x', 'y', source=source, color=color, line_width=3,
+                                   muted_alpha=0.2, muted_color=color, legend_label=label)
+            self._cs_plot.title.text_font_style = "normal"
+            self._cs_plot.sizing_mode = 'stretch_width'
+        return self._cs_plot
+
+    def refresh_view(self):
+        """
+        bring figures up to date with parameters, recalculates only stages with
+        changed inputs and replaces data of existing sources,
+        returns list of figures which have changed"""
+        params = self.params
+        changed = []
+        csd_plot = self.csd_figure()
+        time, solution = self.get('solution')
+        view_key = (self._versions['solution'], tuple(self.shown_ch_states()))
+        if view_key != self._view_key:
+            shown = list(self.shown_ch_states())
+            _, ch_states = self.get('element')
+            colors = [csd.color_picker(len(ch_states), i, palette) for i in range(len(ch_states))]
+            self._csd_source.data = {
+                'xs': [time for _ in shown],
+                'ys': [solution[:, i] for i in shown],
+                'color': [colors[i] for i in shown],
+                'legend_label': [params['element'] + str(i) + '+' for i in shown],
+                'x_label': [time[np.argmax(solution[:, i])] for i in shown],
+                'y_label': [np.amax(solution[:, i]) + 0.01 for i in shown],
+                'text_label': [str(i) + '+' for i in shown]}
+            self._view_key = view_key
+            changed.append(csd_plot)
+        title = params['element'] + ',  Eₑ = ' + \
+            str(round(params['e_e'] / 1000, 2)) + ' keV, ' + 'Jₑ=' + \
+            str(round(params['j_e'], 0)) + ' A/cm², ' + 'Pᵥ=' + str(params['p_vac']) + ' mbar '
+        if (csd_plot.legend[0].visible, self._labels.visible, csd_plot.title.text) != \
+                (params['show_legend'], params['show_labels'], title):
+            csd_plot.legend.visible = params['show_legend']
+            self._labels.visible = params['show_labels']
+            csd_plot.title.text = title
+            if csd_plot not in changed:
+                changed.append(csd_plot)
+
+        if self._cs_plot is not None:
+            cross_sections = self.get('cross_sections')
+            if self._versions['cross_sections'] != self._cs_view_key:
+                _, ch_states = self.get('element')
+                for source, values in zip(self._cs_sources, cross_sections):
+                    # total CX cross section if multiple capture is included
+                    values = np.atleast_2d(values).sum(axis=0)
+                    source.data = {'x': ch_states, 'y': values}
+                self._cs_view_key = self._versions['cross_sections']
+                changed.append(self._cs_plot)
+            title = params['element'] + ',  Eₑ = ' + \
+                str(round(params['e_e'] / 1000, 2)) + ' keV, IP=' + str(params['ip']) + ' eV '
+            if (self._cs_plot.legend[0].visible, self._cs_plot.title.text) != (params['show_legend'], title):
+                self._cs_plot.legend.visible = params['show_legend']
+                self._cs_plot.title.text = title
+                if self._cs_plot not in changed:
+                    changed.append(self._cs_plot)
+        return changed
@@ -1,4 +1,20 @@
+"""
+This script bundles raw FAC ionization energies and subshell populations
+from data/ (or data/data.zip) into elements.json.
+
+Each FAC file is read once, elements are processed in parallel and only
+elements whose input files or Lotz coefficients changed since the last
+build are regenerated. Content hashes of the inputs are kept in a manifest
+next to the output file. Use --force for a full rebuild and --npz to also
+write the element data as padded numpy arrays.
+"""
+import argparse
+import hashlib
 import json
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
 
@@ -9,6 +25,7 @@ name_list = ["H", "He", "Li", "Be", "B", "C", "N", "O", "F", "Ne", "Na", "Mg", "
              "W", "Re", "Os", "Ir", "Pt", "Au", "Hg", "Tl", "Pb", "Bi", "Po", "At", "Rn", "Fr", "Ra", "Ac", "Th", "Pa",
              "U", "Np", "Pu", "Am", "Cm", "Bk", "Cf", "Es", "Fm", "Md", "No", "Lr", "Rf", "Db", "Sg", "Bh", "Hs"]
 
+
 subshell_list = ["1s", "2s", "2p-", "2p+", "3s", "3p-", "3p+", "3d-", "3d+", "4s", "4p-", "4p+", "4d-", "4d+", "5s",
                  "5p-", "5p+", "4f-", "4f+", "5d-", "5d+", "6s", "6p-", "6p+", "5f-", "5f+", "6d-", "6d+", "7s"]
 
@@ -46,66 +63,183 @@ Lotz_coefficients = {"1s": [[4, 0.6, 0.56], [4, 0.75, 0.50]],
                             [3.2, 0.7, 0.3], [3.0, 0.8, 0.25], [2.8, 0.85, 0.2], [2.6, 0.9, 0.18], [2.4, 0.92, 0.17]],
                      "7s": [[4, 0, 0], [4, 0, 0]]}
 
-subshells = []
 
-def charge_state_dict(Z, q):
+# for charge states above this one universal Lotz coefficients are used
+LOTZ_MAX_CHARGE = 4
+LOTZ_UNIVERSAL = [4.5, 0, 0]
+
+
+def read_fac_data(Z, data_dir='data'):
+    """
+    read FAC energies and configuration files of element Z once,
+    returns their text, falls back to data.zip if files are not unpacked"""
+    ip_filename = str(Z) + '.txt'
+    conf_filename = str(Z) + 'conf.txt'
+    if os.path.isfile(os.path.join(data_dir, ip_filename)):
+        with open(os.path.join(data_dir, ip_filename)) as ip_datafile:
+            ip_text = ip_datafile.read()
+        with open(os.path.join(data_dir, conf_filename)) as conf_datafile:
+            conf_text = conf_datafile.read()
+    else:
+        with zipfile.ZipFile(os.path.join(data_dir, 'data.zip')) as archive:
+            ip_text = archive.read(ip_filename).decode()
+            conf_text = archive.read(conf_filename).decode()
+    return ip_text, conf_text
+
+
+def used_principal_subshells(ip_text):
+    """ principal subshells (e.g. '2p') covered by FAC energies file"""
+    columns = len(ip_text.splitlines()[1].split('\t'))
+    return sorted(set(subshell[:2] for subshell in subshell_list[:columns]))
+
+
+def input_digest(ip_text, conf_text):
+    """
+    content hash of everything an element depends on: both FAC files
+    and the Lotz coefficients of the subshells present in them"""
+    lotz = {k: Lotz_coefficients[k] for k in used_principal_subshells(ip_text)}
+    digest = hashlib.sha256()
+    for part in (ip_text, conf_text,
+                 json.dumps([lotz, LOTZ_MAX_CHARGE, LOTZ_UNIVERSAL, subshell_list], sort_keys=True)):
+        digest.update(part.encode())
+    return digest.hexdigest()
+
+
+def charge_state_dict(Z, q, ip_databuffer, conf_databuffer):
+    """
+    subshell energies, populations and Lotz coefficients of charge state q,
+    takes lines of FAC energies (with header) and configuration files"""
     charge_state_dict = {}
 
-    ip_filename = 'data/' + str(Z) + '.txt'
-    ip_datafile = open(ip_filename)
-    ip_databuffer = ip_datafile.readlines()
     charge_state_line = ip_databuffer[q + 1]
     charge_state_buffer = charge_state_line.split('	')
 
-    conf_filename = 'data/' + str(Z) + 'conf.txt'
-    conf_datafile = open(conf_filename)
-    conf_databuffer = conf_datafile.readlines()
     populations_line = conf_databuffer[q]
     populations_buffer = populations_line.split('	')
     principal_subshells = set([subshell_list[i][:2] for i in range(len(charge_state_buffer))])
-    # print(principal_subshells)
     electron_formula = {k: 0 for k in principal_subshells}
-    # print(electron_formula)
 
     total_charge = 0
     for i in range(len(charge_state_buffer)):
         charge_state_dict[subshell_list[i]] = {"E": float(charge_state_buffer[i]), "p": int(populations_buffer[i])}
         electron_formula[subshell_list[i][:2]] = electron_formula[subshell_list[i][:2]] + int(populations_buffer[i])
         total_charge += int(populations_buffer[i])
-    # print(electron_formula)
     if total_charge + q != Z:
-        print('Error in data for', Z, q)
-        print('Population summ=', total_charge)
-        print(electron_formula)
+        raise ValueError('Error in data for Z=' + str(Z) + ' q=' + str(q) +
+                         ': population sum ' + str(total_charge) +
+                         ' does not match ' + str(Z - q) + ' electrons ' + str(electron_formula))
     for i in range(len(charge_state_buffer)):
-        if q <= 4:
-            charge_state_dict[subshell_list[i]]["a"] = \
-            Lotz_coefficients[subshell_list[i][:2]][electron_formula[subshell_list[i][:2]] - 1][0]
-            charge_state_dict[subshell_list[i]]["b"] = \
-                Lotz_coefficients[subshell_list[i][:2]][electron_formula[subshell_list[i][:2]] - 1][1]
-            charge_state_dict[subshell_list[i]]["c"] = \
-                Lotz_coefficients[subshell_list[i][:2]][electron_formula[subshell_list[i][:2]] - 1][2]
+        if q <= LOTZ_MAX_CHARGE:
+            coefficients = Lotz_coefficients[subshell_list[i][:2]][electron_formula[subshell_list[i][:2]] - 1]
         else:
-            charge_state_dict[subshell_list[i]]["a"] = 4.5
-            charge_state_dict[subshell_list[i]]["b"] = 0
-            charge_state_dict[subshell_list[i]]["c"] = 0
+            coefficients = LOTZ_UNIVERSAL
+        charge_state_dict[subshell_list[i]]["a"] = coefficients[0]
+        charge_state_dict[subshell_list[i]]["b"] = coefficients[1]
+        charge_state_dict[subshell_list[i]]["c"] = coefficients[2]
 
     return charge_state_dict
 
 
-json_dict = {}
-for Z in range(1, 95, 1):
-    name = name_list[Z - 1]
-    print(name, Z)
-    charge_states = {}
+def element_dict(Z, ip_text, conf_text):
+    """ all charge states of element Z from the text of its FAC files"""
+    ip_databuffer = ip_text.splitlines()
+    conf_databuffer = conf_text.splitlines()
+    return {str(n): charge_state_dict(Z, n, ip_databuffer, conf_databuffer) for n in range(Z)}
+
+
+def _build_element(job):
+    """ worker entry point for the process pool"""
+    Z, ip_text, conf_text = job
+    return name_list[Z - 1], element_dict(Z, ip_text, conf_text)
+
+
+def element_arrays(charge_states):
+    """
+    pack element dictionary into zero padded arrays of shape (charge states, subshells)
+    for energies, populations and (charge states, subshells, 3) for Lotz a, b, c"""
+    subshells = subshell_list[:len(charge_states['0'])]
+    empty = {"E": 0.0, "p": 0, "a": 0, "b": 0, "c": 0}
+    rows = [[charge_states[str(q)].get(s, empty) for s in subshells] for q in range(len(charge_states))]
+    energies = np.array([[subshell["E"] for subshell in row] for row in rows])
+    populations = np.array([[subshell["p"] for subshell in row] for row in rows], dtype=np.int32)
+    lotz = np.array([[[subshell[k] for k in "abc"] for subshell in row] for row in rows], dtype=float)
+    return energies, populations, lotz
+
+
+def write_npz(path, json_dict):
+    """ write element data as a compressed numpy archive, keys are <name>_E, <name>_p, <name>_abc"""
+    arrays = {}
+    for name, charge_states in json_dict.items():
+        arrays[name + '_E'], arrays[name + '_p'], arrays[name + '_abc'] = element_arrays(charge_states)
+    np.savez_compressed(path, **arrays)
+
+
+def load_previous_build(output, manifest):
+    """ previous elements.json and its manifest, empty if any of them is missing or broken"""
+    try:
+        with open(output) as fp:
+            previous_json = json.load(fp)
+        with open(manifest) as fp:
+            previous_digests = json.load(fp)
+    except (OSError, ValueError):
+        return {}, {}
+    return previous_json, previous_digests
+
+
+def build(data_dir='data', output='elements.json', manifest=None, z_max=94,
+          force=False, workers=None, npz=None):
+    """
+    (re)build elements.json for elements 1..z_max,
+    returns list of element names which were regenerated"""
+    if manifest is None:
+        manifest = os.path.splitext(output)[0] + '.manifest.json'
+    previous_json, previous_digests = ({}, {}) if force else load_previous_build(output, manifest)
+
+    digests = {}
+    jobs = []
+    for Z in range(1, z_max + 1):
+        name = name_list[Z - 1]
+        ip_text, conf_text = read_fac_data(Z, data_dir)
+        digests[name] = input_digest(ip_text, conf_text)
+        if previous_digests.get(name) != digests[name] or name not in previous_json:
+            jobs.append((Z, ip_text, conf_text))
+
+    rebuilt = {}
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rebuilt = dict(executor.map(_build_element, jobs))
+
+    # keep elements ordered by nuclear charge
+    json_dict = {name: rebuilt[name] if name in rebuilt else previous_json[name] for name in digests}
+
+    if rebuilt or set(previous_json) != set(json_dict):
+        with open(output, 'w') as fp:
+            json.dump(json_dict, fp)
+        with open(manifest, 'w') as fp:
+            json.dump(digests, fp, indent=1)
+    if npz is not None:
+        write_npz(npz, json_dict)
+    return list(rebuilt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bundle FAC data into elements.json')
+    parser.add_argument('--data', default='data', help='folder with FAC files or data.zip')
+    parser.add_argument('--output', default='elements.json', help='output JSON file')
+    parser.add_argument('--manifest', default=None, help='input hashes file, default <output>.manifest.json')
+    parser.add_argument('--z-max', type=int, default=94, help='highest nuclear charge to include')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--force', action='store_true', help='rebuild all elements')
+    parser.add_argument('--npz', default=None, help='also write element arrays to this .npz file')
+    args = parser.parse_args()
 
-    for n in range(Z):
-        data_dict = {}
-        charge_states[str(n)] = charge_state_dict(Z, n)
-        # print(str(n))
-    json_dict[name] = charge_states
+    rebuilt = build(data_dir=args.data, output=args.output, manifest=args.manifest,
+                    z_max=args.z_max, force=args.force, workers=args.jobs, npz=args.npz)
+    if rebuilt:
+        print('rebuilt', len(rebuilt), 'elements:', ' '.join(rebuilt))
+    else:
+        print('elements.json is up to date')
 
-    print(len(json_dict[name]))
 
-with open('elements.json', 'w') as fp:
-    json.dump(json_dict, fp)
+if __name__ == '__main__':
+    main()
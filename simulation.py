@@ -8,7 +8,6 @@ from datetime import datetime
 import numpy as np
 from bokeh.palettes import Category20_20 as palette   # import bokeh palette for
 from bokeh.plotting import show
-from scipy.integrate import odeint         # import odeint to integrate system of ODE
 from bokeh.models import ColumnDataSource, Label, LabelSet
 import numba
 import csd
@@ -28,11 +27,14 @@ IP = 13.6  # ionization potential of rest gas
 P_VAC = 1E-10  # vacuum pressure mbar
 J = 5000  # A/cm2
 T_ion = 300  # ion temperature in eV
+CX_MAX = 1  # max number of electrons captured in one CX collision (1..4)
 
 
 # ------------------ define time independent reaction rates-----------------
 
-rates = csd.get_reaction_rates(elem=ELEM, j_e=J, e_e=ENERGY, t_ion=T_ion, p_vac=P_VAC, ip=IP, ch_states=ch_states)
+rates = csd.get_reaction_rates(elem=ELEM, j_e=J, e_e=ENERGY, t_ion=T_ion, p_vac=P_VAC, ip=IP, ch_states=ch_states,
+                               cx_max=CX_MAX)
+bands = csd.rate_bands(*rates)  # banded rate matrix assembled once
 
 #--------------- define initial conditions and time frame----------------
 
@@ -42,9 +44,10 @@ initial_CSD[0] = 1  # starts from some gas injected in a shot
 timescale = np.logspace(-6, 1, num=1000)  # generate  log linear time range
 
 #----------------------- solve system of ODEs-----------------------------------
-# integrate ODE system
+# integrate ODE system, solver and tolerances are picked for the requested accuracy
 
-solution = odeint(csd.csd_evolution, initial_CSD, timescale, args=rates)
+solution, solver_info = csd.solve_csd(initial_CSD, timescale, bands, accuracy=1E-4)
+print('solver:', solver_info['method'], 'rtol:', solver_info['rtol'], 'atol:', solver_info['atol'])
 
 
 print(datetime.now() - startTime) # timing without graphic part
@@ -4,18 +4,16 @@ calculation with user interface based on streamlit package
 
 """
 import streamlit as st
-import numpy as np
-from bokeh.palettes import Category20_20 as palette  # import bokeh palette for
-from bokeh.models import ColumnDataSource, Label, LabelSet
-#from bokeh.plotting import figure, output_file, show
-from scipy.integrate import odeint  # import odeint to integrate system of ODE
 import csd
+import csd_session
 
-# import element data from JSON to a dictionary
+# simulation session keeps figure and intermediate results between reruns of the script,
+# only stages with changed inputs are recalculated, figure is patched in place
+if 'simulation_session' not in st.session_state:
+    st.session_state.simulation_session = csd_session.SimulationSession(t_ion=300)  # ion temperature in eV
+session = st.session_state.simulation_session
 
 ELEMENT_NAME = st.sidebar.selectbox('Select element', csd.ELEM_NAMES)
-# create a dictionary with charge states as iteger keys
-ELEM = csd.get_element_data(ELEMENT_NAME)
 
 def converter(string, default):
     """
@@ -41,87 +39,17 @@ Log_t_upper = st.sidebar.number_input('set log₁₀ time upper time limit', val
 show_legend=st.sidebar.checkbox('show legend', value=True, key=None)
 show_labels=st.sidebar.checkbox('show labels', value=True, key=None)
 
-ch_states_to_show=st.slider('Show charge states', min_value=0, max_value=len(ELEM), value=(0,len(ELEM)), step=1, format=None, key=None)
-
-T_ion = 300  # ion temperature in eV
-ch_states = np.linspace(0, len(ELEM), len(ELEM) + 1)  # define charge states
-
-
-
-
-time = np.logspace(Log_t_lower, Log_t_upper, num=1000)  # generate  log linear time range
-
-
-# below is the cached function that allows to minimize heave recalculations if only UI parameters were changed
-@st.cache
-def cached_solution(ELEM, J, ENERGY, T_ion, P_VAC, IP, ch_states):
-    # ----- define time independent reaction rates
-    rates = csd.get_reaction_rates(elem=ELEM, j_e=J, e_e=ENERGY, t_ion=T_ion, p_vac=P_VAC, ip=IP, ch_states=ch_states)
-    initial_CSD = np.zeros(len(ch_states))
-    initial_CSD[0] = 1
-    # solve system of ODEs
-    solution = odeint(csd.csd_evolution, initial_CSD, time, args=rates)
-
-    return solution
-
-solution=cached_solution(ELEM, J, ENERGY, T_ion, P_VAC, IP, ch_states)
-csd_plot = csd.csd_base_figure()  # instantinate default CSD figure
-
-
+session.update(element=ELEMENT_NAME, e_e=ENERGY, j_e=J, ip=IP, p_vac=P_VAC,
+               log_t=(Log_t_lower, Log_t_upper), show_legend=show_legend, show_labels=show_labels)
+ELEM, ch_states = session.get('element')
 
-# generate color palette for ploting
-colors = [csd.color_picker(len(ch_states), i, palette) for i in range(len(ch_states))]
-
-if show_labels:
-
-    x_label=[time[np.argmax(solution[:, i])] for i in range(ch_states_to_show[0], ch_states_to_show[1]+1, 1)]
-    y_label=[np.amax(solution[:, i]) + 0.01 for i in range(ch_states_to_show[0], ch_states_to_show[1]+1, 1)]
-    text_label=[ ''.join([str(i),'+']) for i in range(ch_states_to_show[0], ch_states_to_show[1]+1, 1)]
-
-    multi_line_source = ColumnDataSource({
-        'color': colors[ch_states_to_show[0]:ch_states_to_show[1]+1],
-        'x_label': x_label,
-        'y_label': y_label,
-        'text_label': text_label
-
-    })
-
-    csd_plot.add_layout(
-        LabelSet(
-            x='x_label',
-            y='y_label',
-            text='text_label',
-            source=multi_line_source,
-            level="overlay",
-            x_offset=0,
-            y_offset=0,
-            render_mode="canvas",
-            text_font_size="10pt",
-            text_color='color',
-            background_fill_color="white",
-            border_line_color="white",
-        )
-    )
-
-
-
-# populate CSD figure and legend
-
-lines = [csd_plot.line(time, solution[:, i], color=colors[i], line_width=3,
-                       muted_alpha=0.2, muted_color=colors[i],
-                  legend_label=ELEMENT_NAME + str(i) + '+') for i in range(ch_states_to_show[0], ch_states_to_show[1]+1, 1)]
-
-if not show_legend:
-    csd_plot.legend.items=[]
+ch_states_to_show=st.slider('Show charge states', min_value=0, max_value=len(ELEM), value=(0,len(ELEM)), step=1, format=None, key=None)
+session.update(min_ch_state=ch_states_to_show[0], max_ch_state=ch_states_to_show[1])
 
-csd_plot.sizing_mode = 'stretch_width'
-csd_plot.title.text = ELEMENT_NAME + ',  Eₑ = ' + \
-                      str(round(ENERGY / 1000, 2)) + ' keV, ' + 'Jₑ=' + \
-                      str(round(J, 0)) + ' A/cm², ' + 'Pᵥ=' + str(P_VAC) + ' mbar '
-csd_plot.title.text_font_style = "normal"
-#csd_plot.sizing_mode = 'stretch_width'
+# recalculate what is needed and update the figure
+session.refresh_view()
+csd_plot = session.csd_figure()
 csd_plot.width = 1000
 csd_plot.height = 600
 
-#st.show(csd_plot)
-st.bokeh_chart(csd_plot)
\ No newline at end of file
+st.bokeh_chart(csd_plot)
@@ -3,10 +3,16 @@ this script contains set of unit tests for PyCB
 unit test check basic functionality as well as
 compare output of CSD.py functions against known reference numbers
 """
+import importlib
+import json
+import os
+import zipfile
 import pytest
 from bokeh.io import curdoc
 import numpy as np
 import csd
+import csd_session
+import batch_runner
 
 
 def test_hydrogen():
@@ -195,3 +201,307 @@ def test_rates():
     func_flat_list = [item for sublist in func_list for item in sublist]
 
     assert all(a == pytest.approx(b) for a, b in zip(func_flat_list, flat_list_test))
+
+
+def test_rate_bands():
+    """
+    test that banded rate matrix reproduces nearest-neighbour csd_evolution
+    for single electron capture and conserves total abundance for
+    capture of up to 4 electrons"""
+    elem = csd.get_element_data('Ar')
+    ch_states = np.linspace(0, len(elem), len(elem) + 1)
+    abundances = np.linspace(1, 2, len(ch_states))
+    rates = csd.get_reaction_rates(elem=elem, j_e=100, e_e=5000, t_ion=100,
+                                   p_vac=1E-8, ip=13.6, ch_states=ch_states)
+    bands = csd.rate_bands(*rates)
+    banded_derivatives = csd.csd_evolution_banded(abundances, 0, bands)
+    dense_derivatives = csd.csd_evolution(abundances, 0, *rates)
+    assert np.allclose(banded_derivatives, dense_derivatives, rtol=1E-12, atol=0)
+
+    rates = csd.get_reaction_rates(elem=elem, j_e=100, e_e=5000, t_ion=100,
+                                   p_vac=1E-8, ip=13.6, ch_states=ch_states, cx_max=4)
+    assert rates[2].shape == (4, len(ch_states))
+    # ion can not capture more electrons than its charge
+    assert rates[2][3][3] == 0
+    bands = csd.rate_bands(*rates)
+    assert bands.shape == (6, len(ch_states))
+    assert abs(sum(csd.csd_evolution_banded(abundances, 0, bands))) < 1E-9 * np.abs(bands).max()
+
+
+def test_solve_csd_banded():
+    """
+    test banded solver against dense odeint solution for single capture"""
+    from scipy.integrate import odeint
+    elem = csd.get_element_data('Ne')
+    ch_states = np.linspace(0, len(elem), len(elem) + 1)
+    rates = csd.get_reaction_rates(elem=elem, j_e=500, e_e=2200, t_ion=300,
+                                   p_vac=1E-9, ip=13.6, ch_states=ch_states)
+    initial_csd = np.zeros(len(ch_states))
+    initial_csd[0] = 1
+    time = np.logspace(-6, 0, num=100)
+    dense_solution = odeint(csd.csd_evolution, initial_csd, time, args=rates)
+    banded_solution = csd.solve_csd_banded(initial_csd, time, csd.rate_bands(*rates))
+    assert np.abs(dense_solution - banded_solution).max() < 1E-5
+
+
+def test_solve_csd():
+    """
+    test automatic tolerance selection: error below requested accuracy
+    with respect to tightly integrated solution, non-negative abundances
+    with conserved total abundance, report of stiff steps, short time
+    range, a single time point and multiple capture for H and He"""
+    elem = csd.get_element_data('Ar')
+    ch_states = np.linspace(0, len(elem), len(elem) + 1)
+    rates = csd.get_reaction_rates(elem=elem, j_e=500, e_e=5000, t_ion=300,
+                                   p_vac=1E-10, ip=13.6, ch_states=ch_states)
+    bands = csd.rate_bands(*rates)
+    initial_csd = np.zeros(len(ch_states))
+    initial_csd[0] = 1
+    time = np.logspace(-6, 1, num=200)
+    reference = csd.solve_csd_banded(initial_csd, time, bands, rtol=1E-12, atol=1E-14)
+    solution, settings = csd.solve_csd(initial_csd, time, bands, accuracy=1E-4)
+    assert settings['method'] == 'LSODA'
+    assert 0 < settings['stiff_fraction'] <= 1
+    assert np.abs(solution - reference).max() < 1E-4
+    assert solution.min() >= 0
+    assert np.allclose(solution.sum(axis=1), 1, rtol=0, atol=1E-12)
+    short_solution, _ = csd.solve_csd(initial_csd, np.linspace(0, 1E-7, 10), bands)
+    assert np.allclose(short_solution.sum(axis=1), 1, rtol=0, atol=1E-12)
+    single_point, _ = csd.solve_csd(initial_csd, np.array([0.0]), bands)
+    assert np.allclose(single_point, [initial_csd])
+    # capture of more electrons than the bare ion charge
+    for name in ('H', 'He'):
+        elem = csd.get_element_data(name)
+        ch_states = np.linspace(0, len(elem), len(elem) + 1)
+        single_capture, multiple_capture = [csd.rate_bands(*csd.get_reaction_rates(
+            elem=elem, j_e=500, e_e=5000, t_ion=300, p_vac=1E-8, ip=13.6, ch_states=ch_states, cx_max=cx_max))
+            for cx_max in (1, 4)]
+        assert multiple_capture.shape == (len(ch_states) + 1, len(ch_states))
+        initial_csd = np.zeros(len(ch_states))
+        initial_csd[0] = 1
+        solution, _ = csd.solve_csd(initial_csd, time, multiple_capture)
+        assert np.allclose(solution.sum(axis=1), 1, rtol=0, atol=1E-12)
+        if name == 'H':
+            assert np.allclose(solution, csd.solve_csd(initial_csd, time, single_capture)[0])
+
+
+def test_periodic_csd():
+    """
+    test breed and extract cycles on example of Ne with 1+ injection:
+    cycles computed with propagator powers reproduce chained ODE solutions,
+    they converge to the periodic steady state which extracts per pulse
+    as many ions as injected"""
+    elem = csd.get_element_data('Ne')
+    ch_states = np.linspace(0, len(elem), len(elem) + 1)
+    rates = csd.get_reaction_rates(elem=elem, j_e=500, e_e=2200, t_ion=300,
+                                   p_vac=1E-9, ip=13.6, ch_states=ch_states, cx_max=2)
+    bands = csd.rate_bands(*rates)
+    assert np.allclose(csd.bands_to_matrix(bands).dot(np.ones(len(ch_states))),
+                       csd.csd_evolution_banded(np.ones(len(ch_states)), 0, bands))
+    injection = np.zeros(len(ch_states))
+    injection[1] = 1
+    extraction = 0.5
+    breeding_time = 1E-3
+
+    trap_csd = np.zeros(len(ch_states))
+    for _ in range(3):
+        trap_csd = csd.solve_csd_banded(trap_csd + injection, np.linspace(0, breeding_time, 10),
+                                        bands, rtol=1E-10, atol=1E-12)[-1]
+        chained_csd = trap_csd
+        trap_csd = trap_csd * (1 - extraction)
+    three_cycles, _ = csd.periodic_csd(bands, breeding_time, injection, extraction, cycles=3)
+    assert np.abs(three_cycles - chained_csd).max() < 1E-6
+
+    steady_csd, steady_yields = csd.periodic_csd(bands, breeding_time, injection, extraction)
+    many_cycles, _ = csd.periodic_csd(bands, breeding_time, injection, extraction, cycles=1000)
+    assert np.abs(many_cycles - steady_csd).max() < 1E-9
+    assert sum(steady_yields) == pytest.approx(1)
+
+    # extracting only low charge states leaves ions accumulating in the trap
+    low_only = np.zeros(len(ch_states))
+    low_only[:2] = 1
+    for extraction in (0, low_only):
+        with pytest.raises(ValueError):
+            csd.periodic_csd(bands, breeding_time, injection, extraction)
+
+
+def test_simulation_session():
+    """
+    test that simulation session recalculates only stages with changed inputs
+    and display only changes patch the existing figure, refresh_view reports
+    only figures which have changed"""
+    session = csd_session.SimulationSession(element='Ne', e_e=2200, j_e=500)
+    csd_plot = session.csd_figure()
+    cs_plot = session.cs_figure()
+    assert session.refresh_view() == [csd_plot, cs_plot]
+    assert session.refresh_view() == []
+    assert session.recalculated == ['element', 'cross_sections', 'rates', 'solution']
+    assert len(session.get('solution')[1][0]) == 11
+
+    session.update(show_labels=False)
+    assert session.refresh_view() == [csd_plot]
+    session.update(show_legend=False, show_labels=False, min_ch_state=5, max_ch_state=8)
+    assert session.refresh_view() == [csd_plot, cs_plot]
+    assert session.recalculated == []
+    assert session.csd_figure() is csd_plot
+    assert not csd_plot.legend.visible
+    assert csd_plot.renderers[0].data_source.data['text_label'] == ['5+', '6+', '7+', '8+']
+
+    session.update(j_e=1000)
+    assert session.refresh_view() == [csd_plot]
+    assert session.recalculated == ['rates', 'solution']
+
+    session.update(element='Ar', max_ch_state=None)
+    session.refresh_view()
+    assert session.recalculated == ['element', 'cross_sections', 'rates', 'solution']
+    assert len(csd_plot.renderers[0].data_source.data['xs']) == 14
+
+
+def test_batch_rates():
+    """
+    test vectorized rates of packed elements against rates of single elements,
+    padding beyond the bare ion must stay zero"""
+    names = ['H', 'C', 'Fe', 'Mo']
+    elems = csd.get_elements_data(names)
+    packed = csd.pack_elements(elems)
+    batch_rates = csd.get_batch_reaction_rates(packed=packed, j_e=500, e_e=20000, t_ion=300,
+                                               p_vac=1E-9, ip=13.6, cx_max=2)
+    for e, elem in enumerate(elems):
+        ch_states = np.linspace(0, len(elem), len(elem) + 1)
+        rates = csd.get_reaction_rates(elem=elem, j_e=500, e_e=20000, t_ion=300,
+                                       p_vac=1E-9, ip=13.6, ch_states=ch_states, cx_max=2)
+        for single, batch in zip(rates, batch_rates):
+            assert np.allclose(single, batch[e][..., :len(ch_states)], rtol=1E-10, atol=0)
+            assert not np.any(batch[e][..., len(ch_states):])
+
+
+def test_scan_elements():
+    """
+    test batched evolution of several elements against solve_csd of each element,
+    injection charge state must exist for all elements"""
+    names = ['He', 'Ne', 'Ar']
+    time = np.logspace(-6, 0, num=100)
+    solution = csd.scan_elements(names, j_e=500, e_e=5000, t_ion=300, p_vac=1E-10,
+                                 ip=13.6, time=time, accuracy=1E-4)
+    assert solution.shape == (3, 100, 19)
+    for e, name in enumerate(names):
+        elem = csd.get_element_data(name)
+        ch_states = np.linspace(0, len(elem), len(elem) + 1)
+        rates = csd.get_reaction_rates(elem=elem, j_e=500, e_e=5000, t_ion=300,
+                                       p_vac=1E-10, ip=13.6, ch_states=ch_states)
+        initial_csd = np.zeros(len(ch_states))
+        initial_csd[0] = 1
+        single, _ = csd.solve_csd(initial_csd, time, csd.rate_bands(*rates), accuracy=1E-5)
+        assert np.abs(solution[e, :, :len(ch_states)] - single).max() < 1E-4
+        assert solution.mask[e, :, len(ch_states):].all()
+        assert not solution.mask[e, :, :len(ch_states)].any()
+    # injection beyond the bare ion of the lightest element
+    with pytest.raises(ValueError):
+        csd.scan_elements(['H', 'He'], j_e=500, e_e=5000, t_ion=300, p_vac=1E-10,
+                          ip=13.6, time=time, injection=2)
+
+
+def test_batch_runner(tmp_path):
+    """
+    test headless runner on a small CSV job list: all jobs are stored once,
+    rerun of finished output does not recalculate anything"""
+    jobs_path = str(tmp_path / 'jobs.csv')
+    with open(jobs_path, 'w') as jobs_file:
+        jobs_file.write('element,e_e,j_e,p_vac,injection,n_t\n')
+        for e_e in (1000, 2000, 3000):
+            jobs_file.write('Ne,' + str(e_e) + ',500,1E-10,1,20\n')
+    output = str(tmp_path / 'output')
+    assert batch_runner.run(jobs_path, output=output, chunk_size=2, workers=1) == 3
+    results = list(batch_runner.load_results(output))
+    assert [result[0] for result in results] == [0, 1, 2]
+    index, job, time, solution, error = results[2]
+    assert job['e_e'] == 3000 and job['injection'] == 1 and error is None
+    assert np.allclose(solution, batch_runner.run_job(job)[1])
+    assert solution.shape == (20, 11)
+    modified = [os.path.getmtime(os.path.join(output, name)) for name in sorted(os.listdir(output))]
+    assert batch_runner.run(jobs_path, output=output, chunk_size=2, workers=1) == 3
+    assert modified == [os.path.getmtime(os.path.join(output, name)) for name in sorted(os.listdir(output))]
+    # resuming with other settings or changed jobs would mix up chunks
+    with pytest.raises(ValueError):
+        batch_runner.run(jobs_path, output=output, chunk_size=2, workers=1, final_only=True)
+    with open(jobs_path, 'a') as jobs_file:
+        jobs_file.write('Ne,4000,500,1E-10,1,20\n')
+    with pytest.raises(ValueError):
+        batch_runner.run(jobs_path, output=output, chunk_size=2, workers=1)
+
+
+def test_batch_runner_failed_job(tmp_path):
+    """
+    test that invalid job or row which can not be parsed is stored with its error
+    and does not stop the run, extra text columns are kept with the job"""
+    jobs_path = str(tmp_path / 'jobs.csv')
+    with open(jobs_path, 'w') as jobs_file:
+        jobs_file.write('element,e_e,j_e,p_vac,n_t,note\n')
+        for element, e_e in (('Ne', '2000'), ('Xx', '2000'), ('Ar', '2000'), ('Ar', 'high')):
+            jobs_file.write(element + ',' + e_e + ',500,1E-10,20,first\n')
+    output = str(tmp_path / 'output')
+    assert batch_runner.run(jobs_path, output=output, chunk_size=2, workers=1, final_only=True) == 4
+    results = list(batch_runner.load_results(output))
+    assert [result[0] for result in results] == [0, 1, 2, 3]
+    assert [result[4] is None for result in results] == [True, False, True, False]
+    assert 'Xx' in results[1][4] and results[1][3] is None
+    assert results[2][1]['element'] == 'Ar' and results[2][3].shape == (19,)
+    assert results[2][1]['note'] == 'first'
+    assert 'high' in results[3][4] and results[3][1]['e_e'] == 'high'
+    assert batch_runner.run(jobs_path, output=output, chunk_size=2, workers=1, final_only=True) == 4
+
+    jobs_path = str(tmp_path / 'jobs.jsonl')
+    with open(jobs_path, 'w') as jobs_file:
+        jobs_file.write('{"element": "Ne", "e_e": 2000, "j_e": 500, "p_vac": 1E-10, "n_t": 20}\n')
+        jobs_file.write('{"element": "Ne", "e_e": 2000,\n')
+        jobs_file.write('{"element": "He", "e_e": 2000, "j_e": 500, "p_vac": 1E-10, "time": [0, 1E-3]}\n')
+    output = str(tmp_path / 'output_jsonl')
+    assert batch_runner.run(jobs_path, output=output, chunk_size=2, workers=1) == 3
+    results = list(batch_runner.load_results(output))
+    assert [result[4] is None for result in results] == [True, False, True]
+    assert results[1][1] == '{"element": "Ne", "e_e": 2000,'
+    assert results[2][2].tolist() == [0, 1E-3] and results[2][3].shape == (2, 3)
+
+
+def test_json_generator(tmp_path, monkeypatch):
+    """
+    test incremental build of elements.json from FAC data of H, He and Li:
+    output matches bundled data, unchanged inputs are skipped, changed FAC files
+    or Lotz coefficients rebuild affected elements, inconsistent data is rejected"""
+    dev = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dev')
+    monkeypatch.syspath_prepend(dev)
+    generator = importlib.import_module('JSON_generator')
+    data = tmp_path / 'data'
+    with zipfile.ZipFile(os.path.join(dev, 'data', 'data.zip')) as archive:
+        archive.extractall(data, [str(z) + suffix for z in (1, 2, 3) for suffix in ('.txt', 'conf.txt')])
+    output = str(tmp_path / 'elements.json')
+    npz = str(tmp_path / 'elements.npz')
+
+    def build(**kwargs):
+        return generator.build(data_dir=str(data), output=output, z_max=3, workers=1, **kwargs)
+
+    assert build(npz=npz) == ['H', 'He', 'Li']
+    with open(os.path.join(dev, 'elements.json')) as bundled_file:
+        bundled = json.load(bundled_file)
+    with open(output) as output_file:
+        assert json.load(output_file) == {name: bundled[name] for name in ('H', 'He', 'Li')}
+    with np.load(npz) as arrays:
+        assert arrays['Li_E'].shape == (3, 2) and arrays['Li_abc'].shape == (3, 2, 3)
+    modified = os.path.getmtime(output)
+    assert build() == []
+    assert os.path.getmtime(output) == modified
+    # changed FAC energies of Li rebuild only Li
+    ip_text = (data / '3.txt').read_text()
+    (data / '3.txt').write_text(ip_text.replace('7.44476435E+01', '7.44476436E+01'))
+    assert build() == ['Li']
+    # all three elements have 1s electrons
+    monkeypatch.setitem(generator.Lotz_coefficients, '1s', [[4.1, 0.6, 0.56], [4.1, 0.75, 0.50]])
+    assert build() == ['H', 'He', 'Li']
+    with open(output) as output_file:
+        assert json.load(output_file)['Li']['1']['1s']['a'] == 4.1
+    assert build() == []
+    assert build(force=True) == ['H', 'He', 'Li']
+    # populations of neutral Li do not add up to three electrons
+    (data / '3conf.txt').write_text('2\t2\n2\n1\n')
+    with pytest.raises(ValueError):
+        build()